@@ -1,18 +1,18 @@
 #!/usr/bin/env python3
+import atexit
+import concurrent.futures
+import itertools
 import logging
 import os
-import pickle
-import subprocess
+import re
 import sys
-from datetime import datetime, timedelta
+import time
 
-import boto3
 import confuse
-import inquirer
 from appdirs import user_data_dir, user_log_dir, user_cache_dir
-from whoosh import index, analysis, fields, sorting
-from whoosh.fields import Schema, TEXT, KEYWORD, ID
-from whoosh.qparser import MultifieldParser, query
+
+# boto3, whoosh and inquirer are imported lazily at first use; together they
+# account for most of the interpreter start-up time.
 
 app_name = "cloudssh"
 app_author = "Haydar Ciftci"
@@ -44,6 +44,8 @@ search_term = None
 provider_instances = []
 server_instances = []
 
+result_row_format = "%-15s | %-40s | %s"
+
 logging_full_path = os.path.join(log_dir, config['logfile'].get())
 logging.basicConfig(filename=logging_full_path,
                     level=config['loglevel'].get())
@@ -56,7 +58,7 @@ class ServerInstance:
 
         :param server_name: Name or label of the server
         :param server_ip_address: The IP address to use
-        :param server_fields: Additional fields to be indexed
+        :param server_fields: Additional fields to be indexed, as a space-separated string
         """
         self.name = server_name
         self.ip_address = server_ip_address
@@ -64,6 +66,9 @@ class ServerInstance:
 
 
 class IndexProcessor:
+    # Bump whenever instance_schema changes so existing indexes are rebuilt.
+    schema_version = 2
+
     def __init__(self, index_config, index_directory_path, index_ttl_file) -> None:
         """
         Processes ServerInstance and adds them to index.
@@ -71,88 +76,179 @@ class IndexProcessor:
         :param index_directory_path: Path to index directory
         :param index_config: Index configuration object
         """
+        from whoosh import analysis, fields, sorting
+        from whoosh.fields import Schema, KEYWORD, ID
+        from whoosh.qparser import MultifieldParser
+
         self.index_ttl_file = os.path.join(index_ttl_file)
         self.index_directory_path = index_directory_path
+        self.schema_version_file = os.path.join(index_directory_path, '_schema_version')
         self.instance_index = None
         self.config = index_config
+        self._ttl = int(self.config['ttl'].get())
+        self._should_index = None
+
+        self.writer_args = {
+            'procs': os.cpu_count(),
+            'limitmb': 256,
+            'multisegment': True,
+        }
+
+        for writer_arg in self.writer_args:
+            try:
+                self.writer_args[writer_arg] = self.config[writer_arg].get()
+            except confuse.NotFoundError:
+                pass
 
         self.instance_schema = Schema(
             private_ip_address=ID(stored=True, analyzer=analysis.StandardAnalyzer(stoplist=None), unique=True),
-            name=TEXT(stored=True, analyzer=analysis.StandardAnalyzer(stoplist=None), sortable=True),
-            tags=KEYWORD(stored=True, scorable=True),
-            created_at=fields.DATETIME(stored=True, sortable=True)
+            name=KEYWORD(stored=True, lowercase=True, scorable=True, sortable=True),
+            tags=KEYWORD(stored=False, scorable=True),
+            created_at=fields.NUMERIC(stored=True, sortable=True, numtype=int)
         )
 
         self.get_index()
 
-    def should_index(self):
-        logging.info("Reading %s index TTL file" % self.index_ttl_file)
+        self.query_parser = MultifieldParser(["name", "tags"], schema=self.instance_schema)
+        self.name_field_facet = sorting.FieldFacet("name")
+        self.score_facet = sorting.ScoreFacet()
+        self._searcher = None
 
-        if not os.path.exists(self.index_ttl_file) or not os.path.getsize(self.index_ttl_file) > 0:
-            logging.info("TTL file doesn't exist or is empty")
-            with open(self.index_ttl_file, 'wb') as ttl_write_handle:
-                default_ttl_time = datetime.now() - timedelta(seconds=self.config['ttl'].get() + 1)
-                pickle.dump(default_ttl_time, ttl_write_handle, pickle.HIGHEST_PROTOCOL)
+        atexit.register(self.close)
 
-        with open(self.index_ttl_file, 'rb') as ttl_read_handle:
-            logging.info("Getting delta for TTL check")
-            last_indexing_time = pickle.load(ttl_read_handle)
-            delta = datetime.now() - last_indexing_time
+    def should_index(self):
+        if self._should_index is not None:
+            return self._should_index
 
-        should_index = delta.seconds > self.config['ttl'].get()
+        logging.info("Checking %s index TTL sentinel" % self.index_ttl_file)
+
+        try:
+            # O_EXCL makes creation atomic, so two concurrent invocations
+            # can't both decide to index.
+            os.close(os.open(self.index_ttl_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL))
+            logging.info("TTL sentinel doesn't exist")
+            should_index = True
+        except FileExistsError:
+            last_indexing_time = os.path.getmtime(self.index_ttl_file)
+            should_index = (time.time() - last_indexing_time) > self._ttl
+
+            if should_index:
+                os.utime(self.index_ttl_file, None)
 
         logging.info("TTL calculation result: should_index=%s" % should_index)
 
-        if should_index:
-            with open(self.index_ttl_file, 'wb') as ttl_write_handle:
-                pickle.dump(datetime.now(), ttl_write_handle, pickle.HIGHEST_PROTOCOL)
+        self._should_index = should_index
 
         return should_index
 
+    def _force_index(self):
+        """
+        Marks the index for an immediate rebuild and refreshes the TTL sentinel
+        so the forced rebuild counts as a regular indexing run.
+
+        """
+        self._should_index = True
+
+        with open(self.index_ttl_file, 'a'):
+            os.utime(self.index_ttl_file, None)
+
+    def _stored_schema_version(self):
+        """
+        Returns the schema version recorded beside the index, 0 if unknown.
+
+        :return: The recorded schema version.
+        """
+        try:
+            with open(self.schema_version_file) as version_handle:
+                return int(version_handle.read())
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def _write_schema_version(self):
+        """
+        Records the current schema version beside the index.
+
+        """
+        with open(self.schema_version_file, 'w') as version_handle:
+            version_handle.write(str(self.schema_version))
+
     def get_index(self):
         """
         Opens or crates the index.
 
         """
+        from whoosh.filedb.filestore import FileStorage
+
         if not os.path.exists(self.index_directory_path):
             os.mkdir(self.index_directory_path)
-            self.instance_index = index.create_in(self.index_directory_path, self.instance_schema)
-            logging.info('Created index at %s' % self.index_directory_path)
+
+        self.storage = FileStorage(self.index_directory_path, supports_mmap=True)
+
+        if self.storage.index_exists():
+            if self._stored_schema_version() == self.schema_version:
+                self.instance_index = self.storage.open_index()
+                logging.info('Using index at %s' % self.index_directory_path)
+            else:
+                # An index written by an older release carries the old on-disk
+                # schema; searching it would hand back the wrong field types.
+                # Recreate it and force a rebuild regardless of the TTL.
+                self.instance_index = self.storage.create_index(self.instance_schema)
+                self._force_index()
+                logging.info('On-disk schema is outdated, recreated index at %s' % self.index_directory_path)
         else:
-            self.instance_index = index.open_dir(self.index_directory_path)
-            logging.info('Using index at %s' % self.index_directory_path)
+            self.instance_index = self.storage.create_index(self.instance_schema)
+            logging.info('Created index at %s' % self.index_directory_path)
+
+        self._write_schema_version()
 
-    def update_index(self, instances):
+    def update_index(self, instance_iter):
         """
         Adds provided instances to the index.
 
-        :param instances: List of instances to be indexed.
+        :param instance_iter: Iterable of instances to be indexed.
         """
+        from whoosh import writing
+
         if not self.should_index():
             logging.info('Index is still valid, TTL not reached')
             return None
 
-        num_deleted = self.instance_index.delete_by_query(
-            query.DateRange("created_at", None, datetime.now() - timedelta(seconds=self.config['ttl'].get()))
-        )
-
-        if num_deleted is None:
-            num_deleted = 0
-
-        logging.info('Deleted %d expired instances from index' % num_deleted)
-
-        writer = self.instance_index.writer()
-        for instance in instances:
-            writer.update_document(
+        writer = self.instance_index.writer(**self.writer_args)
+        num_indexed = 0
+        for instance in instance_iter:
+            writer.add_document(
                 private_ip_address=instance.ip_address,
                 name=instance.name,
-                tags=str.join(' ', instance.fields),
-                created_at=datetime.utcnow()
+                tags=instance.fields,
+                created_at=int(time.time())
             )
             logging.debug('Added %s to index' % instance.ip_address)
+            num_indexed += 1
 
-        writer.commit()
-        logging.info('Indexed %d instances' % len(instances))
+        # CLEAR drops the old segments at commit time, so the previous
+        # snapshot survives if the lookup raises mid-stream.
+        writer.commit(mergetype=writing.CLEAR)
+        logging.info('Indexed %d instances' % num_indexed)
+
+    def get_searcher(self):
+        """
+        Returns a searcher for the index, reusing the cached one while it is up to date.
+
+        :return: A Whoosh searcher.
+        """
+        if self._searcher is None or not self._searcher.up_to_date():
+            self._searcher = self.instance_index.searcher()
+
+        return self._searcher
+
+    def close(self):
+        """
+        Closes the cached searcher, if any.
+
+        """
+        if self._searcher is not None:
+            self._searcher.close()
+            self._searcher = None
 
     def search(self, query_search_term):
         """
@@ -161,13 +257,9 @@ class IndexProcessor:
         :param query_search_term: The query to be used for the search.
         :return:
         """
-        qp = MultifieldParser(["name", "tags"], schema=self.instance_schema)
-        q = qp.parse(query_search_term)
-
-        name_field_facet = sorting.FieldFacet("name")
-        scores = sorting.ScoreFacet()
+        q = self.query_parser.parse(query_search_term)
 
-        search_results = self.instance_index.searcher().search(q, limit=15, sortedby=[scores, name_field_facet])
+        search_results = self.get_searcher().search(q, limit=15, sortedby=[self.score_facet, self.name_field_facet])
 
         return search_results
 
@@ -180,6 +272,11 @@ class AwsProvider:
         :param aws_config: AWS provider configuration
         """
         self.config = aws_config
+        self._filters = [
+            {'Name': instance_filter['Name'].get(), 'Values': instance_filter['Values'].get()}
+            for instance_filter in aws_config['filters']
+        ]
+        self._address_field = aws_config['address_field'].get()
 
     @staticmethod
     def get_name():
@@ -193,48 +290,51 @@ class AwsProvider:
     def lookup(self):
         """
         Looks up the running instances based on the provider configuration provided.
-        :return: List of ServerInstances.
+        :return: Generator of ServerInstances, one page of reservations at a time.
         """
-        instance_filters = []
-        instances = []
-        instance_fields = []
-
-        for instance_filter in self.config['filters']:
-            instance_filters.append({'Name': instance_filter['Name'].get(), 'Values': instance_filter['Values'].get()})
+        import boto3
 
         ec2client = boto3.client('ec2')
-        response = ec2client.describe_instances(Filters=instance_filters)
-        logging.info('Received %d reservations' % len(response['Reservations']))
-
-        for reservation in response['Reservations']:
-            for instance in reservation['Instances']:
-                instance_name = ''
-                for tag in instance['Tags']:
-                    if tag['Key'] == 'Name':
-                        instance_name = tag['Value']
-
-                    instance_fields.append(tag['Value'])
-
-                instances.append(ServerInstance(
-                    server_name=instance_name,
-                    server_fields=instance_fields,
-                    server_ip_address=instance[self.config['address_field'].get()]
-                ))
+        paginator = ec2client.get_paginator('describe_instances')
+        pages = paginator.paginate(Filters=self._filters, PaginationConfig={'PageSize': 1000})
 
-        logging.info('Lookup returned %d instances' % len(instances))
-        return instances
+        for page in pages:
+            logging.info('Received %d reservations' % len(page['Reservations']))
 
+            for reservation in page['Reservations']:
+                for instance in reservation['Instances']:
+                    instance_name = next((tag['Value'] for tag in instance['Tags'] if tag['Key'] == 'Name'), '')
+                    instance_fields = ' '.join({tag['Value'] for tag in instance['Tags']})
 
-for provider in config['providers']:
-    if provider == 'aws':
-        aws = AwsProvider(config['providers'][provider])
-        provider_instances.append(aws)
+                    yield ServerInstance(
+                        server_name=instance_name,
+                        server_fields=instance_fields,
+                        server_ip_address=instance[self._address_field]
+                    )
 
-for provider in provider_instances:
-    server_instances += provider.lookup()
 
 processor = IndexProcessor(config['index'], index_full_dir, os.path.join(cache_dir, 'ttl'))
-processor.update_index(server_instances)
+
+if processor.should_index():
+    for provider in config['providers']:
+        if provider == 'aws':
+            aws = AwsProvider(config['providers'][provider])
+            provider_instances.append(aws)
+
+    if len(provider_instances) == 1:
+        # A single provider streams page by page straight into the writer.
+        processor.update_index(provider_instances[0].lookup())
+    else:
+        # Several providers are independent network round-trips, so overlap
+        # them in a pool; each worker materializes only its own provider's
+        # batch before the batches are chained into the writer.
+        with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+            server_instances = itertools.chain.from_iterable(
+                executor.map(lambda lookup_provider: list(lookup_provider.lookup()), provider_instances)
+            )
+            processor.update_index(server_instances)
+else:
+    logging.info('Index is still valid, skipping provider lookup')
 
 if len(sys.argv) > 1:
     search_term = str.join(' ', sys.argv[1:])
@@ -247,19 +347,21 @@ else:
 if len(search_term) > 0:
     logging.info("Searching for '%s'..." % search_term)
     results = processor.search(search_term)
-    logging.info("Found %s matches..." % len(results))
-    prompt_choices = []
-
-    if len(results) > 0:
-
-        for result in results:
-            prompt_choices.append(
-                "{0} | {1} | {2}".format(
-                    result['private_ip_address'].ljust(15),
-                    result['name'].ljust(40),
-                    result['created_at'].strftime("%H:%M:%S")
-                ).strip()
-            )
+
+    if results:
+        import inquirer
+
+        # Sortable fields are column-backed, so timestamps come straight from
+        # the column store without touching the stored-fields file.
+        created_at_column = processor.get_searcher().reader().column_reader('created_at')
+
+        prompt_choices = [
+            result_row_format % (result['private_ip_address'], result['name'],
+                                 time.strftime('%H:%M:%S', time.gmtime(created_at_column[result.docnum])))
+            for result in results
+        ]
+
+        logging.info("Found %s matches..." % len(prompt_choices))
 
         questions = [
             inquirer.List(
@@ -271,7 +373,12 @@ if len(search_term) > 0:
 
         answers = inquirer.prompt(questions)
         try:
-            ip_address = answers['ip_address'].split(' ')[0]
-            subprocess.call('ssh ' + ip_address, shell=True)
+            ip_address = answers['ip_address'].split(' ', 1)[0]
         except TypeError:
             pass
+        else:
+            if re.fullmatch(r'[A-Za-z0-9._:-]+', ip_address) and not ip_address.startswith('-'):
+                os.execvp('ssh', ['ssh', '--', ip_address])
+            else:
+                logging.error("Refusing to connect to malformed address '%s'" % ip_address)
+                print("Refusing to connect to malformed address '%s'" % ip_address, file=sys.stderr)